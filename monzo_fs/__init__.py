@@ -3,13 +3,27 @@
 """Defines the various functions to support the Monzo fuse filesystem."""
 
 import calendar
+import collections
 import datetime
-import json
+import errno
+import heapq
+import logging
+import sys
+import threading
 
 import diazed
+import fuse
+import iso8601
 from monzo_fs.decorators import cache, singleton, appendnewline, to_2dp
-from monzo_fs.diazed import readdir, readlink, mixed
+from monzo_fs.diazed import readdir, readlink, mixed, xattrs
+from monzo_fs.diazed import INTERACTIVE, BULK
+from monzo_fs.diskcache import DiskCache, DEFAULT_DIRECTORY, DEFAULT_MAX_BYTES
+from monzo_fs.fields import FieldTableCache
 from monzo_fs.monzo import MonzoAPI
+from monzo_fs.series import TransactionSeries, CombinedSeries
+
+# The name of the folder that combines every account.
+ALL = 'all'
 
 
 def transaction_list_cache():
@@ -24,6 +38,39 @@ def transaction_list_cache():
         return singleton('transaction-list-cache', {})
 
 
+def field_table_cache():
+    """Holds the rendered FieldTables of recently read transactions, keyed by
+    the transaction id and whether they include merchant details.
+
+    :returns: the FieldTableCache singleton.
+    """
+    try:
+        return singleton(FieldTableCache)
+    except:
+        return singleton(FieldTableCache, FieldTableCache())
+
+
+def attachment_cache():
+    """The on-disk cache that holds downloaded attachment bytes.
+
+    :returns: the DiskCache singleton (created with defaults if not set).
+    """
+    try:
+        return singleton(DiskCache)
+    except:
+        return singleton(DiskCache,
+                         DiskCache(DEFAULT_DIRECTORY, DEFAULT_MAX_BYTES))
+
+
+def _by_month(account_id, year, month, *rest):
+    """The scheduling priority of paths within a month. The current month is
+    treated as interactive while older months are bulk (e.g. a find)."""
+    today = datetime.datetime.now()
+    if (year, month) == (str(today.year), '%02d' % today.month):
+        return INTERACTIVE
+    return BULK
+
+
 @cache(datetime.timedelta(minutes=5))
 def _get_transaction(transaction_id, merchant):
     """Return a transaction dict for the transaction with the given id.
@@ -42,69 +89,386 @@ def _get_transaction(transaction_id, merchant):
     return singleton(MonzoAPI).get_transaction(transaction_id, merchant)
 
 
-@readdir('/')
+def _get_fields(transaction_id, merchant):
+    """Return the FieldTable for a transaction, only rendering it again if
+    the transaction has been updated since it was last rendered."""
+    transaction = _get_transaction(transaction_id, merchant)
+    return field_table_cache().get((transaction_id, merchant), transaction)
+
+
 @cache(datetime.timedelta(days=1))
+def _get_accounts():
+    return singleton(MonzoAPI).get_accounts()
+
+
+def _get_account(account_id):
+    """Return the account dict for the account with the given id."""
+    for account in _get_accounts():
+        if account['id'] == account_id:
+            return account
+    raise fuse.FuseOSError(errno.ENOENT)
+
+
+def _account_ids():
+    return [a['id'] for a in _get_accounts()]
+
+
+def _map_accounts(fn, account_ids, *args):
+    """Calls fn(account_id, *args) for each account, in parallel for calls
+    that aren't answered from fn's cache.
+
+    :param fn: A callable taking an account id (and args), optionally
+               decorated with @cache.
+    :param account_ids: The ids of the accounts.
+    :param args: Further arguments for fn.
+    :returns: The list of results, in the same order as the accounts.
+    """
+    results = [None] * len(account_ids)
+    errors = []
+
+    def _run(i):
+        try:
+            results[i] = fn(account_ids[i], *args)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    is_cached = getattr(fn, 'is_cached', lambda *a: False)
+    misses = [i for i in xrange(len(account_ids))
+              if not is_cached(account_ids[i], *args)]
+    if len(misses) < 2:
+        # There is nothing to wait for in parallel.
+        misses = []
+    for i in xrange(len(account_ids)):
+        if i not in misses:
+            _run(i)
+
+    threads = []
+    for i in misses:
+        target = lambda i=i: _run(i)
+        if diazed.fs.recorder is not None:
+            # Attribute events on these threads to the traced operation.
+            target = diazed.fs.recorder.wrap(target)
+        threads.append(threading.Thread(target=target))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _this_month():
+    """Return the (year, month) strs of the current month (e.g. "2016",
+    "08")."""
+    now = datetime.datetime.utcnow()
+    return str(now.year), '%02d' % now.month
+
+
+def _refresh(account_id):
+    try:
+        _get_balance(account_id)
+        transactions_in_year_month(account_id, *_this_month())
+    except Exception:
+        logging.exception('Failed to refresh %s', account_id)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(account_id)
+
+
+def refresh_accounts(account_ids):
+    """Brings the balance and current month listing of each account up to
+    date in the background, all in parallel (an account is only refreshed by
+    one thread at a time, and not at all while both are still cached). Series
+    are left to be built when they are read, as that can mean walking the
+    account's whole history.
+
+    :param account_ids: The ids of the accounts to refresh.
+    """
+    for account_id in account_ids:
+        if _get_balance.is_cached(account_id) and \
+                transactions_in_year_month.is_cached(account_id,
+                                                     *_this_month()):
+            continue
+        with _refreshing_lock:
+            if account_id in _refreshing:
+                continue
+            _refreshing.add(account_id)
+        thread = threading.Thread(target=_refresh, args=(account_id,))
+        thread.daemon = True
+        thread.start()
+
+
+@readdir('/', priority=INTERACTIVE)
 def list_accounts():
-    """List out all the account IDs for the current user."""
-    return [a['id'] for a in singleton(MonzoAPI).get_accounts()]
+    """List out all the account IDs for the current user (and the folder that
+    combines them), starting to bring every account up to date."""
+    account_ids = _account_ids()
+    refresh_accounts(account_ids)
+    return [ALL] + account_ids
+
+
+# The routes under /all are registered before the per account routes so they
+# take precedence. Paths they don't handle (e.g. the fields of a transaction)
+# fall through to the per account routes, which don't need the account id.
+
+
+def _all_month_index():
+    """The months in which any account may have transactions."""
+    months = set()
+    for account in _get_accounts():
+        months.update(_month_index(account['id']))
+    return months
+
+
+@readdir('/' + ALL + '/transactions', priority=INTERACTIVE)
+def all_transactions():
+    """List out the years in which any account has transactions."""
+    return sorted(set(m[:4] for m in _all_month_index()))
 
 
-@readdir('/<account>')
+@readdir('/' + ALL + '/transactions/<year>', priority=INTERACTIVE)
+def all_months_in_year(year):
+    """List out the months in the year in which any account has
+    transactions."""
+    return sorted(m[5:] for m in _all_month_index()
+                  if m.startswith(year + '-'))
+
+
+@readdir('/' + ALL + '/transactions/<year>/<month>',
+         priority=lambda year, month: _by_month(ALL, year, month))
+@cache(datetime.timedelta(minutes=1))
+def all_transactions_in_year_month(year, month):
+    """List the transaction ids from every account that occurred in the given
+    year/month, ordered by when they were created."""
+    account_ids = [a for a in _account_ids()
+                   if (year + '-' + month) in _month_index(a)]
+
+    # Each account's listing is already in created order (and fills the list
+    # cache), so they only need to be merged.
+    cache = transaction_list_cache()
+    listings = [[(cache[i]['created'], i) for i in listing]
+                for listing in _map_accounts(transactions_in_year_month,
+                                             account_ids, year, month)]
+    ids = [i for _, i in heapq.merge(*listings)]
+    if not ids:
+        raise fuse.FuseOSError(errno.ENOENT)
+    return diazed.Dir(ids, st_nlink=(2 + len(ids)))
+
+
+def _get_combined_series():
+    """Return a CombinedSeries over every account's (up to date) series."""
+    series = _map_accounts(_get_series, _account_ids())
+    combined = series_cache().get(ALL)
+    if combined is None or combined.series != series:
+        combined = series_cache()[ALL] = CombinedSeries(series)
+    return combined
+
+
+@readlink('/' + ALL + '/series/<name>', priority=BULK, limit=2)
+def all_series_file(name):
+    """Builds (or brings up to date) the combined series of every account."""
+    if name not in _SERIES:
+        raise fuse.FuseOSError(errno.ENOENT)
+    return getattr(_get_combined_series(), _SERIES[name])()
+
+
+def _get_all_balances():
+    """Return the balance and spend today of every account, summed up by
+    currency."""
+    balances = collections.defaultdict(lambda: {'balance': 0,
+                                                'spend_today': 0})
+    for balance in _map_accounts(_get_balance, _account_ids()):
+        if 'currency' not in balance:
+            continue
+        total = balances[balance['currency']]
+        total['balance'] += balance.get('balance', 0)
+        total['spend_today'] += balance.get('spend_today', 0)
+    return balances
+
+
+@readdir('/' + ALL + '/balance', priority=INTERACTIVE)
+def list_all_balance():
+    """List out a folder for each currency held across the accounts."""
+    return sorted(_get_all_balances())
+
+
+@readdir('/' + ALL + '/balance/<currency>', priority=INTERACTIVE)
+def list_all_balance_currency(currency):
+    if currency not in _get_all_balances():
+        raise fuse.FuseOSError(errno.ENOENT)
+    return ['balance', 'spend_today']
+
+
+@readlink('/' + ALL + '/balance/<currency>/<field>', priority=INTERACTIVE)
+@appendnewline
+def all_balance_field(currency, field):
+    total = _get_all_balances().get(currency, {})
+    if field not in total:
+        raise fuse.FuseOSError(errno.ENOENT)
+    return '%.02f' % (total[field] / 100.0)
+
+
+@readdir('/<account>', priority=INTERACTIVE)
 @cache(datetime.timedelta(days=1))
 def list_account(account_id):
     """For a specific account list the subfolders that are available."""
-    return ['transactions', 'balance']
+    return ['transactions', 'balance', 'series']
+
+
+# How long a month that was listed and found empty is left out of the tree
+# (transactions can be posted late or back-dated).
+_EMPTY_MONTH_TTL = datetime.timedelta(minutes=1)
 
 
-@readdir('/<account>/transactions')
+def month_index_cache():
+    """Holds the number of transactions found in each month (keyed "YYYY-MM")
+    that has been listed and when it was listed, for each account.
+
+    :returns: a singleton dict instance that can be used as a cache.
+    """
+    try:
+        return singleton('month-index-cache')
+    except:
+        return singleton('month-index-cache', {})
+
+
+def _month_index(account_id):
+    """Return the set of months (e.g. "2016-08") in which the account may have
+    transactions: those from when it was created until now, less any that
+    were found to be empty in the last minute (the current month is always
+    included)."""
+    created = iso8601.parse_date(_get_account(account_id)['created'])
+    now = datetime.datetime.utcnow()
+    counts = month_index_cache().get(account_id, {})
+    months = set(['%04d-%02d' % (now.year, now.month)])
+    year, month = created.year, created.month
+    while (year, month) < (now.year, now.month):
+        key = '%04d-%02d' % (year, month)
+        count, listed = counts.get(key, (None, None))
+        if count != 0 or now - listed > _EMPTY_MONTH_TTL:
+            months.add(key)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+@readdir('/<account>/transactions', priority=INTERACTIVE)
 def transactions(account_id):
-    """List out the years for which we could have transaction data."""
-    return [str(y) for y in xrange(2015, datetime.datetime.now().year + 1)]
+    """List out the years in which the account may have transactions."""
+    return sorted(set(m[:4] for m in _month_index(account_id)))
 
 
-@readdir('/<account>/transactions/<year>')
+@readdir('/<account>/transactions/<year>', priority=INTERACTIVE)
 def months_in_year(account_id, year):
-    """List out the months for which transaction data could be avaialble."""
-    today = datetime.datetime.now()
-    if int(year) != today.year:
-        return ['%02d' % m for m in xrange(1, 13)]
-    else:
-        return ['%02d' % m for m in xrange(1, today.month + 1)]
+    """List out the months in the year in which the account may have
+    transactions."""
+    return sorted(m[5:] for m in _month_index(account_id)
+                  if m.startswith(year + '-'))
 
 
-@readdir('/<account>/transactions/<year>/<month>')
+@readdir('/<account>/transactions/<year>/<month>', priority=_by_month)
 @cache(datetime.timedelta(minutes=1))
 def transactions_in_year_month(account_id, year, month):
     """List the transaction ids that occurred in the given year/month."""
+    key = year + '-' + month
+    if key not in _month_index(account_id):
+        # Don't spend an API call on a month we know to be empty.
+        raise fuse.FuseOSError(errno.ENOENT)
+
     year = int(year)
     month = int(month)
     date_from = datetime.datetime(year=year, month=month, day=1)
-    date_to = datetime.datetime(year=year,
-                                month=month,
-                                day=calendar.monthrange(year, month)[1])
-    transactions = singleton(MonzoAPI).list_transactions(account_id,
+    date_to = date_from + datetime.timedelta(
+        days=calendar.monthrange(year, month)[1])
+    transactions = singleton(MonzoAPI).iter_transactions(account_id,
                                                          date_from,
                                                          date_to)
-    # Cache the result of listing the transactions so we can re-use it.
+    # Cache the result of listing the transactions so we can re-use it, and
+    # just return the ids which act as folders (which each add a link).
     cache = transaction_list_cache()
+    ids = []
     for transaction in transactions:
-        transaction['merchant'] = {}
         cache[transaction['id']] = transaction
+        ids.append(transaction['id'])
 
-    # Just return the ids which act as folders.
-    return [t['id'] for t in transactions]
+    # Empty months are left out of the year for a while.
+    month_index_cache().setdefault(account_id, {})[key] = (
+        len(ids), datetime.datetime.utcnow())
+    return diazed.Dir(ids, st_nlink=(2 + len(ids)))
 
 
-@readdir('/<account>/transactions/<year>/<month>/<txn>')
+@readdir('/<account>/transactions/<year>/<month>/<txn>',
+         priority=_by_month)
 def transaction_fields(account_id, year, month, transaction_id):
     """List the fields available in the transaction."""
-    return _get_transaction(transaction_id, False).keys() + ['json']
+    return _get_fields(transaction_id, False).get(())
 
 
-@readlink('/<account>/transactions/<year>/<month>/<txn>/json')
+@readlink('/<account>/transactions/<year>/<month>/<txn>/json',
+          priority=_by_month)
 def transaction_as_json(account_id, year, month, transaction_id):
     """A special file to print the given transaction as JSON."""
-    return json.dumps(_get_transaction(transaction_id, True))
+    return _get_fields(transaction_id, True).get(('json',))
+
+
+def _get_attachment(transaction_id, n):
+    """Return the n'th attachment dict for the given transaction."""
+    attachments = _get_transaction(transaction_id, False).get('attachments')
+    try:
+        return (attachments or [])[int(n)]
+    except (ValueError, IndexError):
+        raise fuse.FuseOSError(errno.ENOENT)
+
+
+@cache(datetime.timedelta(days=1))
+def _get_attachment_size(file_url):
+    return singleton(MonzoAPI).get_attachment_size(file_url)
+
+
+@mixed(
+    operations=[
+        'readlink',
+        'readdir'
+    ],
+    paths=[
+        '/<account>/transactions/<year>/<month>/<txn>/attachments',
+        '/<account>/transactions/<year>/<month>/<txn>/attachments/<n>',
+        '/<account>/transactions/<year>/<month>/<txn>/attachments/<n>/<f1>'
+    ],
+    priority=_by_month
+)
+@appendnewline
+def attachment_from_transaction(account_id, year, month, transaction_id,
+                                n=None, field=None):
+    """Lists the attachments on a transaction, each of which is a folder
+    holding its metadata and a "file" with the attachment itself."""
+    if n is None:
+        txn = _get_transaction(transaction_id, False)
+        return [str(i) for i in xrange(len(txn.get('attachments') or []))]
+
+    attachment = _get_attachment(transaction_id, n)
+    if field is None:
+        return attachment.keys() + ['file']
+
+    if field == 'file':
+        # Only the size is needed up front (which doesn't require downloading
+        # the file), the contents are fetched in ranges as they are read.
+        file_url = attachment['file_url']
+        fetch = lambda start, length: singleton(MonzoAPI).get_attachment_range(
+            file_url, start, length)
+        size = _get_attachment_size(file_url)
+        return diazed.File(
+            lambda offset, length: attachment_cache().read(
+                attachment['id'], offset, length, size, fetch),
+            size=size)
+
+    return attachment.get(field, '')
 
 
 @mixed(
@@ -116,28 +480,95 @@ def transaction_as_json(account_id, year, month, transaction_id):
         '/<account>/transactions/<year>/<month>/<txn>/<f1>',
         '/<account>/transactions/<year>/<month>/<txn>/<f1>/<f2>',
         '/<account>/transactions/<year>/<month>/<txn>/<f1>/<f2>/<f3>'
-    ]
+    ],
+    priority=_by_month
 )
-@appendnewline
 def field_from_transaction(account_id, year, month, transaction_id,
                            field, subfield=None, subsubfield=None):
-    merchant = (field == 'merchant')
-    txn = _get_transaction(transaction_id, merchant)
-    if not merchant:
-        txn['merchant'] = {}
-
-    ret = txn.get(field, '')
-    if subfield:
-        ret = ret.get(subfield, '')
+    # Merchant details are only fetched when they are asked for.
+    table = _get_fields(transaction_id, field == 'merchant')
     if subsubfield:
-        ret = ret.get(subsubfield, '')
-    if type(ret) is dict:
-        ret = ret.keys()
+        return table.get((field, subfield, subsubfield))
+    if subfield:
+        return table.get((field, subfield))
+    return table.get((field,))
+
+
+@xattrs('/<account>/transactions/<year>/<month>/<txn>',
+        namespace='user.monzo.', priority=_by_month)
+def transaction_xattrs(account_id, year, month, transaction_id,
+                       _fuse_name=None):
+    """Exposes every scalar field of a transaction as a user.monzo.* extended
+    attribute, so they can all be read without opening any files."""
+    # Merchant details are only fetched when they are read, everything else
+    # (including the merchant's id) comes from the listing of the month.
+    if _fuse_name is not None:
+        merchant = _fuse_name.startswith('user.monzo.merchant.')
+        return _get_fields(transaction_id, merchant).attrs
+
+    # Listing never fetches merchant details, but lists them if we have them.
+    attrs = dict(_get_fields(transaction_id, False).attrs)
+    if _get_transaction.is_cached(transaction_id, True):
+        for name, value in _get_fields(transaction_id, True).attrs.iteritems():
+            if name.startswith('user.monzo.merchant.'):
+                attrs[name] = value
+    return attrs
+
+
+def series_cache():
+    """Holds a TransactionSeries for each account, keyed by account id.
+
+    :returns: a singleton dict instance that can be used as a cache.
+    """
+    try:
+        return singleton('series-cache')
+    except:
+        return singleton('series-cache', {})
+
+
+def _remember(transactions):
+    """Stores transactions in the list cache as they are streamed through, so
+    they can be re-used when reading their fields."""
+    cache = transaction_list_cache()
+    for transaction in transactions:
+        cache.setdefault(transaction['id'], transaction)
+        yield transaction
+
+
+@cache(datetime.timedelta(minutes=1))
+def _get_series(account_id):
+    """Return the TransactionSeries for an account, first appending any
+    transactions created since it was last updated."""
+    series = series_cache().setdefault(account_id, TransactionSeries())
+
+    def _fetch(since):
+        since = since or _get_account(account_id)['created']
+        return _remember(singleton(MonzoAPI).iter_transactions(
+            account_id, iso8601.parse_date(since), datetime.datetime.utcnow()))
+    series.update(_fetch)
+    return series
+
+
+# The files in a series folder and the method that renders each of them.
+_SERIES = {
+    'daily_spend.csv': 'daily_spend_csv',
+    'running_balance.csv': 'running_balance_csv',
+    'category_by_month.csv': 'category_by_month_csv',
+}
+
+
+@readdir('/<account>/series', priority=INTERACTIVE)
+def list_series(account_id):
+    return sorted(_SERIES)
 
-    if field in ('amount', 'local_amount', 'account_balance'):
-        return '%.02f' % (float(ret) / 100.0)
 
-    return ret
+@readlink('/<account>/series/<name>', priority=BULK, limit=2)
+def series_file(account_id, name):
+    """Builds (or brings up to date) the account's series, which can mean
+    walking the whole history so only a couple are built at a time."""
+    if name not in _SERIES:
+        raise fuse.FuseOSError(errno.ENOENT)
+    return getattr(_get_series(account_id), _SERIES[name])()
 
 
 @cache(datetime.timedelta(seconds=30))
@@ -145,25 +576,25 @@ def _get_balance(account_id):
     return singleton(MonzoAPI).get_balance(account_id)
 
 
-@readdir('/<account>/balance')
+@readdir('/<account>/balance', priority=INTERACTIVE)
 def list_balance(account_id):
     return ['balance', 'currency', 'spend_today']
 
 
-@readlink('/<account>/balance/balance')
+@readlink('/<account>/balance/balance', priority=INTERACTIVE)
 @appendnewline
 @to_2dp
 def balance_balance(account_id):
     return _get_balance(account_id).get('balance', '')
 
 
-@readlink('/<account>/balance/currency')
+@readlink('/<account>/balance/currency', priority=INTERACTIVE)
 @appendnewline
 def balance_currency(account_id):
     return _get_balance(account_id).get('currency', '')
 
 
-@readlink('/<account>/balance/spend_today')
+@readlink('/<account>/balance/spend_today', priority=INTERACTIVE)
 @appendnewline
 @to_2dp
 def balance_spend_today(account_id):
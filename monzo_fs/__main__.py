@@ -4,36 +4,189 @@
 import argparse
 import logging
 import os
+import sys
 
 import diazed
 import fuse
 from monzo_fs.decorators import singleton
+from monzo_fs.diskcache import DiskCache, DEFAULT_DIRECTORY, DEFAULT_MAX_BYTES
 from monzo_fs.monzo import MonzoAPI
+from monzo_fs.shared import CacheClient, CacheDaemon, DEFAULT_SOCKET
+from monzo_fs.snapshot import SnapshotAPI, write_snapshot
+from monzo_fs.trace import TraceRecorder, load, replay, format_stats
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('mount_point', help='location to mount the file system')
+def snapshot(argv):
+    """Writes an offline snapshot of the user's accounts to a file."""
+    parser = argparse.ArgumentParser(prog='monzo-fs snapshot',
+                                     description='Snapshot a Monzo account.')
+    parser.add_argument('output', help='where to write the snapshot')
     parser.add_argument('--logfile', default=None)
     parser.add_argument('--verbose', action='store_true', default=False)
-    parser.add_argument('--background', action='store_true', default=False)
     parser.add_argument('--client_id',
                         required=True,
                         help='Your Monzo API client.')
     parser.add_argument('--client_secret',
                         required=True,
                         help='Your Monzo API secret.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        filename=args.logfile,
+        level=(logging.DEBUG if args.verbose else logging.INFO))
+
+    m = MonzoAPI(args.client_id, args.client_secret)
+    m.initialize()
+    write_snapshot(m, args.output)
+
+
+def _add_common_arguments(parser):
+    """Adds the arguments used to configure the API backend and file system."""
+    parser.add_argument('--logfile', default=None)
+    parser.add_argument('--verbose', action='store_true', default=False)
+    parser.add_argument('--client_id',
+                        help='Your Monzo API client.')
+    parser.add_argument('--client_secret',
+                        help='Your Monzo API secret.')
+    parser.add_argument('--snapshot',
+                        default=None,
+                        help='Serve a snapshot file instead of the API.')
+    parser.add_argument('--cache_dir',
+                        default=DEFAULT_DIRECTORY,
+                        help='Where to cache downloaded attachments.')
+    parser.add_argument('--cache_size',
+                        type=int,
+                        default=(DEFAULT_MAX_BYTES // (1024 * 1024)),
+                        help='Maximum size of the attachment cache in MiB.')
+    parser.add_argument('--cache_socket',
+                        default=None,
+                        help=('Share API responses with other processes via '
+                              'the cache daemon listening on this socket.'))
+    parser.add_argument('--endpoint_limit',
+                        action='append',
+                        default=[],
+                        metavar='ENDPOINT=N',
+                        help=('Allow at most N concurrent requests to an API '
+                              'endpoint (e.g. transactions=2).'))
+    parser.add_argument('--threads',
+                        type=int,
+                        default=8,
+                        help=('Worker threads that run handlers in priority '
+                              'order, or 0 to run them on FUSE threads.'))
+    parser.add_argument('--bulk_deadline',
+                        type=float,
+                        default=None,
+                        help=('Shed bulk requests (e.g. old months) queued '
+                              'for longer than this many seconds.'))
+    parser.add_argument('--serve_stale',
+                        action='store_true',
+                        default=False,
+                        help='Answer shed requests with earlier results.')
+
+
+def _initialize(parser, args):
+    """Sets up logging and the singletons used by the file system."""
+    if not args.snapshot and not (args.client_id and args.client_secret):
+        parser.error('--client_id and --client_secret are required unless '
+                     'using a --snapshot.')
 
     logging.basicConfig(
         filename=args.logfile,
         level=(logging.DEBUG if args.verbose else logging.INFO))
 
-    m = singleton(MonzoAPI, MonzoAPI(args.client_id, args.client_secret))
+    try:
+        endpoint_limits = dict((e, int(n)) for e, n in
+                               (l.split('=', 1) for l in args.endpoint_limit))
+    except ValueError:
+        parser.error('--endpoint_limit must look like transactions=2.')
+
+    if args.threads:
+        deadlines = {}
+        if args.bulk_deadline is not None:
+            deadlines[diazed.BULK] = args.bulk_deadline
+        diazed.fs.scheduler = diazed.Scheduler(args.threads,
+                                               deadlines=deadlines,
+                                               stale=args.serve_stale)
+
+    if args.snapshot:
+        m = singleton(MonzoAPI, SnapshotAPI(args.snapshot))
+    else:
+        shared_cache = None
+        if args.cache_socket:
+            shared_cache = CacheClient(args.cache_socket)
+        m = singleton(MonzoAPI, MonzoAPI(args.client_id,
+                                         args.client_secret,
+                                         shared_cache=shared_cache,
+                                         endpoint_limits=endpoint_limits))
+    singleton(DiskCache, DiskCache(args.cache_dir,
+                                   args.cache_size * 1024 * 1024))
 
     # Perform initialization, which involves authorizing the user if required.
     m.initialize()
 
+
+def replay_trace(argv):
+    """Replays a trace recorded with --trace and prints latency percentiles."""
+    parser = argparse.ArgumentParser(prog='monzo-fs replay',
+                                     description='Replay a monzo-fs trace.')
+    parser.add_argument('trace', help='a trace written with --trace')
+    parser.add_argument('--speed',
+                        type=float,
+                        default=1.0,
+                        help='Speed up factor, or 0 for as fast as possible.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='Number of threads issuing operations.')
+    _add_common_arguments(parser)
+    args = parser.parse_args(argv)
+    _initialize(parser, args)
+
+    stats = replay(load(args.trace), diazed.fs, args.speed, args.concurrency)
+    print format_stats(stats)
+
+
+def cache_daemon(argv):
+    """Runs a cache daemon shared by the monzo-fs processes on this host."""
+    parser = argparse.ArgumentParser(prog='monzo-fs cache-daemon',
+                                     description='Run a shared cache daemon.')
+    parser.add_argument('--socket',
+                        default=DEFAULT_SOCKET,
+                        help='The Unix socket to listen on.')
+    parser.add_argument('--logfile', default=None)
+    parser.add_argument('--verbose', action='store_true', default=False)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        filename=args.logfile,
+        level=(logging.DEBUG if args.verbose else logging.INFO))
+
+    logging.info('Cache daemon listening on %s', args.socket)
+    CacheDaemon(args.socket).serve_forever()
+
+
+def main():
+    if sys.argv[1:2] == ['snapshot']:
+        return snapshot(sys.argv[2:])
+    if sys.argv[1:2] == ['replay']:
+        return replay_trace(sys.argv[2:])
+    if sys.argv[1:2] == ['cache-daemon']:
+        return cache_daemon(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser.add_argument('mount_point', help='location to mount the file system')
+    parser.add_argument('--background', action='store_true', default=False)
+    parser.add_argument('--trace',
+                        default=None,
+                        help='Append a trace of every operation to this file.')
+    _add_common_arguments(parser)
+    args = parser.parse_args()
+    _initialize(parser, args)
+
+    if args.trace:
+        # Line buffered so the trace is usable while the file system runs.
+        diazed.fs.recorder = TraceRecorder(open(args.trace, 'a', 1))
+
     if not os.path.exists(args.mount_point):
         os.mkdir(args.mount_point)
 
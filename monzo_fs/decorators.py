@@ -5,6 +5,9 @@
 import datetime
 import json
 
+from monzo_fs import trace
+from monzo_fs.diazed import Dir, File, _BUFFER_TYPES
+
 
 _singleton = {}
 
@@ -31,7 +34,9 @@ def singleton(key, value=None):
 
 def cache(timedelta):
     """Returns a decorator that memoizes the wrapped function (based on
-    JSON serialization of positional and keyword args).
+    JSON serialization of positional and keyword args). The wrapped function
+    has an is_cached(*args, **kwargs) attribute that says whether a call with
+    those args would be answered from the cache.
 
     :param timedelta: A datetime.timedelta instance for cache lifetime.
     :returns: A callable that can be used as a decorator for a function.
@@ -50,32 +55,48 @@ def cache(timedelta):
 
             if expires:
                 if datetime.datetime.now() < expires:
+                    trace.note('cache_hit')
                     return cache[key]
                 else:
                     cache[key] = None
                     cache_expiry[key] = None
 
+            trace.note('cache_miss')
             cache[key] = fn(*args, **kwargs)
             cache_expiry[key] = datetime.datetime.now() + timedelta
 
             return cache[key]
+
+        def _is_cached(*args, **kwargs):
+            expires = cache_expiry.get(json.dumps(args) + json.dumps(kwargs))
+            return bool(expires) and datetime.datetime.now() < expires
+
+        _cache.is_cached = _is_cached
         return _cache
     return _decorator
 
 
 def appendnewline(fn):
     """Returns a function that calls the given function and appends an ascii
-    newline byte to the result (if the result is not a list or dict). The
-    result of the function is also interpreted as bytes.
+    newline byte to the result, returning it as a diazed File. Unicode is
+    encoded as UTF-8 and other scalars are interpreted as bytes. Lists, dicts,
+    diazed objects and buffers are returned unchanged (lazy contents must be
+    returned as a diazed File with a size).
 
     :param fn: A callable to be wrapped.
     :return: A callable that invokes fn and appends a newline byte.
     """
     def _decorator(*a, **k):
         r = fn(*a, **k)
-        if type(r) not in (list, dict):
-            r = bytes(r) + b'\n'
-        return r
+        if type(r) in (list, dict) or isinstance(r, (Dir, File)):
+            return r
+        elif type(r) is unicode:
+            r = r.encode('utf8')
+        elif type(r) is not bytes and isinstance(r, _BUFFER_TYPES):
+            return r
+        elif type(r) is not bytes:
+            r = bytes(r)
+        return File(r + b'\n')
     return _decorator
 
 
@@ -15,7 +15,9 @@ because it would be shadowed by the first.
 
 Handler functions can return primative types (e.g. a directory can be
 represented as a list of strings) or they can return diazed.Dir or diaezd.File
-instances.
+instances. A File can wrap a buffer, a memory mapped file or a function that
+produces a range of bytes, in which case only the bytes that are read are ever
+produced.
 
   Typical usage example:
 
@@ -36,17 +38,43 @@ instances.
       # registered first.
       return 'You are reading %s.' % file
 
+  @read('/big.bin')
+  def read_big(_fuse_size, _fuse_offset, _fuse_fh):
+      # Handlers registered with @read are passed the FUSE arguments, so
+      # they can serve a slice of a file without producing all of it.
+      return fetch_bytes(_fuse_offset, _fuse_size)
+
   fuse.FUSE(fs, '/tmp/myfs', foreground=True, direct_io=True)
 """
 
 import collections
 import errno
+import itertools
+import mmap
+import os
 import re
 import stat
+import threading
+import time
 
 import fuse
 
 
+# Contents that File can slice without first converting them to bytes.
+_BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+# macOS reports a missing extended attribute as ENOATTR, Linux as ENODATA.
+_ENOATTR = getattr(errno, 'ENOATTR', errno.ENODATA)
+
+# Priorities for handlers, when a Scheduler is used lower values run first.
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+_Route = collections.namedtuple(
+    '_Route', ['pattern', 'callback', 'fuseargs', 'priority', 'limit'])
+
+
 class Dir:
     """Represents a directory containing a list of nodes."""
 
@@ -66,17 +94,75 @@ class Dir:
 
 
 class File:
-    """Represents a file with byte contents."""
+    """Represents a file with byte contents.
+
+    Contents can be anything that supports slicing without copying the whole
+    file (bytes, bytearray, memoryview or mmap objects), or a producer function
+    (offset, size) -> bytes together with the size of the file. Use
+    File.from_path to serve an existing file on disk via a memory map.
+    """
 
-    def __init__(self, contents):
+    def __init__(self, contents, size=None, **attrs):
         """Constructs a File instance.
 
-        :param contents: The contents of the file, which will become bytes.
+        :param contents: The contents of the file. Buffers and callables are
+                         kept as is, unicode is encoded as UTF-8 and anything
+                         else will become bytes.
+        :param size: The size of the file, required if contents is callable.
+        :param attrs: Additional attributes for this file.
         """
-
-        self.contents = bytes(contents)
+        if callable(contents):
+            if size is None:
+                raise ValueError('Lazy file contents require a size.')
+        elif type(contents) is unicode:
+            contents = contents.encode('utf8')
+        elif not isinstance(contents, _BUFFER_TYPES):
+            contents = bytes(contents)
+
+        self.contents = contents
+        self.size = len(contents) if size is None else size
         self.attrs = dict(st_mode=(stat.S_IFREG | 0o444),
-                          st_size=len(self.contents))
+                          st_size=self.size)
+        for key, value in attrs.iteritems():
+            self.attrs[key] = value
+
+    @classmethod
+    def from_path(cls, path, **attrs):
+        """Constructs a File that serves the file at path via a memory map.
+
+        :param path: The path of the file on disk.
+        :param attrs: Additional attributes for this file.
+        :returns: A File instance.
+        """
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if not size:
+                # It is not possible to mmap an empty file.
+                return cls(b'', **attrs)
+            # The mapping stays valid after the file is closed.
+            contents = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(contents, **attrs)
+
+    def read(self, offset, size):
+        """Returns up to size bytes from offset, copying only that range.
+
+        :param offset: The offset of the first byte to read.
+        :param size: The maximum number of bytes to read.
+        :returns: The bytes in the requested range.
+        """
+        size = max(0, min(size, self.size - offset))
+        contents = self.contents
+        if callable(contents):
+            return contents(offset, size) if size else b''
+        elif type(contents) is bytes:
+            if offset == 0 and size == len(contents):
+                return contents
+            return contents[offset:offset + size]
+        elif isinstance(contents, memoryview):
+            return contents[offset:offset + size].tobytes()
+        else:
+            return bytes(contents[offset:offset + size])
+
 
 def _resolve_fs(_fs):
     """Resolves a specific file system, or returns the global one.
@@ -91,51 +177,111 @@ def _resolve_fs(_fs):
         return fs
 
 
-def readlink(path, _fs=None):
+def readlink(path, priority=NORMAL, limit=None, _fs=None):
     """Registers a function that reads a 'file' with the given fs.
 
     :param path: The path to match (e.g. "/<file>").
+    :param priority: The scheduling priority (see _DiazedFileSystem.on).
+    :param limit: The maximum number of concurrent calls (see Scheduler).
     :param _fs: An optional _DiazedFileSystem instance (mostly for testing).
     :returns: A decorator that will register the function with fs for path.
     """
     fs = _resolve_fs(_fs)
-    return _get_decorator(fs, operations=['readlink'], paths=[path])
+    return _get_decorator(fs, operations=['readlink'], paths=[path],
+                          priority=priority, limit=limit)
 
 
-def readdir(path, _fs=None):
+def readdir(path, priority=NORMAL, limit=None, _fs=None):
     """Decorates a function that lists a 'directory'.
 
     :param path: The path to match (e.g. "/<file>").
+    :param priority: The scheduling priority (see _DiazedFileSystem.on).
+    :param limit: The maximum number of concurrent calls (see Scheduler).
+    :param _fs: An optional _DiazedFileSystem instance (mostly for testing).
+    :returns: A decorator that will register the function with fs for path.
+    """
+    fs = _resolve_fs(_fs)
+    return _get_decorator(fs, operations=['readdir'], paths=[path],
+                          priority=priority, limit=limit)
+
+
+def read(path, priority=NORMAL, limit=None, _fs=None):
+    """Registers a function that reads part of a 'file' with the given fs.
+
+    Unlike other handlers the function is passed the FUSE arguments for the
+    read as keyword arguments (_fuse_size, _fuse_offset and _fuse_fh) and
+    should return only the requested bytes.
+
+    :param path: The path to match (e.g. "/<file>").
+    :param priority: The scheduling priority (see _DiazedFileSystem.on).
+    :param limit: The maximum number of concurrent calls (see Scheduler).
+    :param _fs: An optional _DiazedFileSystem instance (mostly for testing).
+    :returns: A decorator that will register the function with fs for path.
+    """
+    fs = _resolve_fs(_fs)
+    return _get_decorator(fs, operations=['read'], paths=[path],
+                          fuseargs=True, priority=priority, limit=limit)
+
+
+def xattrs(path, namespace='user.', priority=NORMAL, limit=None, _fs=None):
+    """Registers a function that returns the extended attributes of a path as
+    a dict of name to bytes (e.g. {"user.size": "10"}).
+
+    The function is passed the name being read as the _fuse_name keyword
+    argument (None when the attributes are being listed), and only needs to
+    return that attribute. Names outside namespace (e.g. "security.selinux",
+    which is read on every ls -l) fail without calling the function.
+
+    :param path: The path to match (e.g. "/<file>").
+    :param namespace: The prefix of every attribute the function provides.
+    :param priority: The scheduling priority (see _DiazedFileSystem.on).
+    :param limit: The maximum number of concurrent calls (see Scheduler).
     :param _fs: An optional _DiazedFileSystem instance (mostly for testing).
     :returns: A decorator that will register the function with fs for path.
     """
     fs = _resolve_fs(_fs)
-    return _get_decorator(fs, operations=['readdir'], paths=[path])
+
+    def _decorator(fn):
+        fs.xattr_namespaces.add(namespace)
+        fs.on('xattrs', path, fn, fuseargs=True, priority=priority,
+              limit=limit)
+        return fn
+    return _decorator
 
 
-def mixed(operations, paths, _fs=None):
+def mixed(operations, paths, priority=NORMAL, limit=None, _fs=None):
     """Decorates a function that supports multiple types of action.
 
     :param operations: The list of operations (e.g. ["readlink"]).
     :param paths: The paths to match (e.g. ["/<file>", "/<file>.txt"]).
+    :param priority: The scheduling priority (see _DiazedFileSystem.on).
+    :param limit: The maximum number of concurrent calls (see Scheduler).
     :param _fs: An optional _DiazedFileSystem instance (mostly for testing).
     :returns: A decorator that will register the function with fs for path.
     """
     fs = _resolve_fs(_fs)
-    return _get_decorator(fs, operations=operations, paths=paths)
+    return _get_decorator(fs, operations=operations, paths=paths,
+                          priority=priority, limit=limit)
 
 
-def _get_decorator(fs, operations, paths):
+def _get_decorator(fs, operations, paths, fuseargs=False, priority=NORMAL,
+                   limit=None):
     """Decorator to wrap a function that returns the contents of a path.
 
     :param paths: the set of paths to handle.
+    :param fuseargs: whether the function should be passed the FUSE kwargs.
+    :param priority: the scheduling priority of the function.
+    :param limit: the maximum number of concurrent calls to the function.
     :return: a File object, bytes or something that will be turned into bytes.
     """
     def _decorator(fn):
         # Register the function as a handler for all the paths + operations.
+        # All of them share a single concurrency limit.
+        shared_limit = _Limit(limit) if limit else None
         for path in paths:
             for operation in operations:
-                fs.on(operation, path, _curry(fn, _ensure_obj))
+                fs.on(operation, path, _curry(fn, _ensure_obj), fuseargs,
+                      priority, shared_limit)
         return fn
     return _decorator
 
@@ -146,10 +292,10 @@ def _ensure_obj(x):
     :param x: The object to cast or pass through.
     :returns: An instance of Dir or File based on the type of x.
     """
-    t = type(x)
-    if t in (Dir, File):
+    # Dir and File are old-style classes, so type(x) is not enough here.
+    if isinstance(x, (Dir, File)):
         return x
-    elif t in (list, tuple, set):
+    elif type(x) in (list, tuple, set):
         return Dir(x)
     else:
         return File(x)
@@ -175,6 +321,155 @@ def _curry(*fns):
     return __curry
 
 
+class _Limit:
+    """A cap on the number of concurrent calls to a handler."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+
+
+class _Job:
+    """A call to a handler waiting to be run by a Scheduler."""
+
+    def __init__(self, priority, seq, deadline, limit, key, call):
+        self.priority = priority
+        self.seq = seq
+        self.deadline = deadline
+        self.limit = limit
+        self.key = key
+        self.call = call
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Scheduler:
+    """Runs handlers on a pool of worker threads, most urgent first.
+
+    Jobs run in order of priority (then arrival), except that a job whose
+    handler is at its concurrency limit waits for a call to that handler to
+    finish. Jobs that wait longer than the deadline for their priority are
+    shed: they fail with EAGAIN, or if stale is set and the same call has
+    succeeded before they are answered with that earlier result instead.
+    """
+
+    def __init__(self, workers, deadlines=None, stale=False, max_stale=1024):
+        """Constructs a Scheduler. Its worker threads are started by the first
+        call to run(), as threads don't survive FUSE forking into the
+        background.
+
+        :param workers: The number of worker threads.
+        :param deadlines: An optional dict of priority -> max seconds queued.
+        :param stale: Whether to answer shed jobs with earlier results.
+        :param max_stale: The number of earlier results to remember.
+        """
+        self.deadlines = deadlines or {}
+        self.stale = stale
+        self.max_stale = max_stale
+        self._results = collections.OrderedDict()
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.workers = workers
+        self._started = False
+
+    def _start(self):
+        """Starts the worker threads (the condition must be held)."""
+        for _ in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+        self._started = True
+
+    def run(self, priority, limit, key, call):
+        """Queues call and blocks until a worker has run it.
+
+        :param priority: The priority of the call (e.g. INTERACTIVE).
+        :param limit: An optional _Limit shared by calls to the same handler.
+        :param key: A hashable key identifying the call (for stale results).
+        :param call: A callable taking no arguments.
+        :returns: The result of call.
+        """
+        deadline = self.deadlines.get(priority)
+        if deadline is not None:
+            deadline += time.time()
+        job = _Job(priority, next(self._seq), deadline, limit, key, call)
+        with self._cond:
+            if not self._started:
+                self._start()
+            self._queue.append(job)
+            self._cond.notify()
+
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _next(self):
+        """Removes and returns the most urgent runnable job, shedding expired
+        jobs on the way (the condition must be held)."""
+        now = time.time()
+        best = None
+        for job in list(self._queue):
+            if job.deadline is not None and job.deadline < now:
+                self._queue.remove(job)
+                self._shed(job)
+            elif job.limit and job.limit.running >= job.limit.limit:
+                continue
+            elif best is None or (job.priority, job.seq) < (best.priority,
+                                                            best.seq):
+                best = job
+        if best is not None:
+            self._queue.remove(best)
+        return best
+
+    def _timeout(self):
+        """Returns the seconds until the earliest queued deadline, or None if
+        no queued job has one (the condition must be held)."""
+        deadlines = [job.deadline for job in self._queue
+                     if job.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _shed(self, job):
+        if self.stale and job.key in self._results:
+            job.result = self._results[job.key]
+        else:
+            job.error = fuse.FuseOSError(errno.EAGAIN)
+        job.done.set()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None:
+                    # Sleep until a job arrives or finishes (both notify), or
+                    # until a queued job is due to be shed.
+                    self._cond.wait(self._timeout())
+                    job = self._next()
+                if job.limit:
+                    job.limit.running += 1
+
+            try:
+                job.result = job.call()
+            except Exception as e:
+                job.error = e
+
+            with self._cond:
+                if job.limit:
+                    job.limit.running -= 1
+                    # Jobs held back by this limit may now be runnable.
+                    self._cond.notify_all()
+                if self.stale and job.error is None:
+                    self._results.pop(job.key, None)
+                    self._results[job.key] = job.result
+                    if len(self._results) > self.max_stale:
+                        self._results.popitem(last=False)
+            job.done.set()
+
+
 class _UnableToRouteException(Exception):
     """Thrown when an action is unable to route for the given path."""
     pass
@@ -186,16 +481,49 @@ class _DiazedFileSystem(fuse.LoggingMixIn, fuse.Operations):
     def __init__(self):
         self.routes = collections.defaultdict(lambda: [])
         self.fd = 0
-
-    def on(self, operation, route, callback):
+        # Optionally set to an object with begin() and record() methods (e.g.
+        # a monzo_fs.trace.TraceRecorder) to trace every operation.
+        self.recorder = None
+        # Optionally set to a Scheduler to run handlers on worker threads.
+        self.scheduler = None
+        # The prefixes of the extended attributes that handlers provide.
+        self.xattr_namespaces = set()
+
+    def __call__(self, op, *args):
+        recorder = self.recorder
+        if recorder is None:
+            return super(_DiazedFileSystem, self).__call__(op, *args)
+
+        recorder.begin()
+        error = None
+        start = time.time()
+        try:
+            return super(_DiazedFileSystem, self).__call__(op, *args)
+        except OSError as e:
+            error = e.errno
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            recorder.record(op, args, start, time.time(), error)
+
+    def on(self, operation, route, callback, fuseargs=False, priority=NORMAL,
+           limit=None):
         """Registers a handler for a specific operation/route pair.
 
         :param operation: The str name of the operation (e.g. "readlink").
         :param route: The str route to handle (e.g. "/<file>.txt").
         :param callback: A callback to call when route/operation is matched.
+        :param fuseargs: Whether to pass the "_fuse_" kwargs to the callback.
+        :param priority: The priority of the handler when scheduled, or a
+                         callable that is passed the groups matched in the
+                         path and returns the priority.
+        :param limit: An optional _Limit on concurrent calls when scheduled.
         """
         route = '^' + re.sub('<[^>]*>', '([^/]*)', route) + '$'
-        self.routes[operation].append((re.compile(route), callback))
+        self.routes[operation].append(
+            _Route(re.compile(route), callback, fuseargs, priority, limit))
 
     def route(self, operation, path, **fuseargs):
         """Handles a specific routing of a path (e.g. "/foo/bar") to a handler.
@@ -206,12 +534,25 @@ class _DiazedFileSystem(fuse.LoggingMixIn, fuse.Operations):
         :throws: _UnableToRouteException if unable to handle path + operation.
         :returns: The value returned by the callback for the given path + op.
         """
-        for route, callback in self.routes[operation]:
-            match = route.match(path)
-            if match is not None:
-                # TODO(tomhennigan) Find a way to optionally pass **fuseargs
-                #                   without requiring them to be passed. 
-                return callback(*match.groups())
+        for route in self.routes[operation]:
+            match = route.pattern.match(path)
+            if match is None:
+                continue
+
+            args = match.groups()
+            kwargs = fuseargs if route.fuseargs else {}
+            if self.scheduler is None:
+                return route.callback(*args, **kwargs)
+
+            priority = route.priority
+            if callable(priority):
+                priority = priority(*args)
+            call = lambda: route.callback(*args, **kwargs)
+            if self.recorder is not None:
+                # Attribute events on the worker to the traced operation.
+                call = self.recorder.wrap(call)
+            key = (operation, path, tuple(sorted(kwargs.items())))
+            return self.scheduler.run(priority, route.limit, key, call)
         raise _UnableToRouteException('Unable to handle %s' % path)
 
     def _create_fuse_args(self, **kwargs):
@@ -232,7 +573,8 @@ class _DiazedFileSystem(fuse.LoggingMixIn, fuse.Operations):
         return ['.', '..'] + self.route('readdir', path, **kwargs).contents
 
     def readlink(self, path):
-        return self.route('readlink', path).contents
+        f = self.route('readlink', path)
+        return f.read(0, f.size)
 
     def getattr(self, path, fh=None):
         kwargs = self._create_fuse_args(fh=fh)
@@ -250,17 +592,23 @@ class _DiazedFileSystem(fuse.LoggingMixIn, fuse.Operations):
         raise fuse.FuseOSError(errno.ENOENT)
 
     def getxattr(self, path, name, position=0):
-        kwargs = self._create_fuse_args(name=name, position=position)
+        if not name.startswith(tuple(self.xattr_namespaces)):
+            raise fuse.FuseOSError(_ENOATTR)
+
+        kwargs = self._create_fuse_args(name=name)
         try:
-            return self.route('getxattr', path, **kwargs)
+            value = self.route('xattrs', path, **kwargs).get(name)
         except _UnableToRouteException:
-            pass
+            value = None
 
-        return ''
+        if value is None:
+            raise fuse.FuseOSError(_ENOATTR)
+        return value
 
     def listxattr(self, path):
+        kwargs = self._create_fuse_args(name=None)
         try:
-            return self.route('listxattr', path)
+            return self.route('xattrs', path, **kwargs).keys()
         except _UnableToRouteException:
             pass
 
@@ -279,12 +627,12 @@ class _DiazedFileSystem(fuse.LoggingMixIn, fuse.Operations):
     def read(self, path, size, offset, fh):
         kwargs = self._create_fuse_args(size=size, offset=offset, fh=fh)
         try:
-            return self.route('read', path, **kwargs).contents
+            return self.route('read', path, **kwargs).read(0, size)
         except _UnableToRouteException:
             pass
 
-        # Fallback to reading the whole file and slicing ourselves.
-        return self.readlink(path)[offset:offset + size]
+        # Fallback to slicing the file returned by the readlink handler.
+        return self.route('readlink', path).read(offset, size)
 
     def statfs(self, path):
         return {}
@@ -0,0 +1,166 @@
+# coding=utf8
+
+"""A size bounded, least recently used cache of byte blocks on disk.
+
+Objects (e.g. receipt images) are split into fixed size blocks which are stored
+as individual files in the cache directory. Reads for a byte range of an object
+are served from cached blocks where possible, and any runs of missing blocks
+are fetched with a single call per run (e.g. one HTTP range request). Cached
+blocks are memory mapped, so only the bytes being read are copied.
+
+  Typical usage example:
+
+  cache = DiskCache('/tmp/cache', max_bytes=(64 * 1024 * 1024))
+  data = cache.read('some-key', offset, size, total_size,
+                    lambda start, length: fetch_range(url, start, length))
+"""
+
+import collections
+import hashlib
+import os
+import threading
+
+from monzo_fs.diazed import File
+
+# Where the cache lives unless told otherwise (next to the ~/.mondofs config).
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.mondofs-cache')
+
+# The default upper bound on the total size of the cache.
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class DiskCache:
+    """Caches blocks of bytes on disk, evicting the least recently used."""
+
+    def __init__(self, directory, max_bytes, block_size=(64 * 1024)):
+        """Construct a DiskCache instance.
+
+        :param directory: The directory to store blocks in (created if needed).
+        :param max_bytes: The maximum total size of all blocks in the cache.
+        :param block_size: The size of the blocks objects are split into.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._total = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Rebuild the LRU order from a previous run using modification times.
+        names = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            names.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(names):
+            self._entries[name] = size
+            self._total += size
+
+        with self._lock:
+            self._evict()
+
+    def _filename(self, key, block):
+        return '%s.%d' % (hashlib.sha1(key).hexdigest(), block)
+
+    def get(self, key, block):
+        """Returns the given block of key as a (memory mapped) diazed File, or
+        None if missing."""
+        name = self._filename(key, block)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            # Mark as most recently used.
+            self._entries[name] = self._entries.pop(name)
+
+        try:
+            return File.from_path(os.path.join(self.directory, name))
+        except (IOError, OSError):
+            with self._lock:
+                self._forget(name)
+            return None
+
+    def put(self, key, block, data):
+        """Stores data as the given block of key, evicting old blocks."""
+        name = self._filename(key, block)
+        path = os.path.join(self.directory, name)
+
+        # Write to a temporary file first so readers never see partial blocks.
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp, path)
+
+        with self._lock:
+            self._forget(name)
+            self._entries[name] = len(data)
+            self._total += len(data)
+            self._evict()
+
+    def read(self, key, offset, size, total_size, fetch):
+        """Reads size bytes from offset in the object identified by key.
+
+        :param key: A str that uniquely identifies the object.
+        :param offset: The offset of the first byte to read.
+        :param size: The maximum number of bytes to read.
+        :param total_size: The size of the whole object.
+        :param fetch: A callable (start, length) -> bytes for missing ranges.
+        :returns: The bytes in the requested range.
+        """
+        end = min(offset + size, total_size)
+        if offset >= end:
+            return b''
+
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = [self.get(key, b) for b in xrange(first, last + 1)]
+
+        # Fetch each contiguous run of missing blocks with a single call.
+        i = 0
+        while i < len(blocks):
+            if blocks[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(blocks) and blocks[j] is None:
+                j += 1
+            start = (first + i) * self.block_size
+            length = min((first + j) * self.block_size, total_size) - start
+            data = fetch(start, length)
+            for k in xrange(i, j):
+                lo = (k - i) * self.block_size
+                block = data[lo:lo + self.block_size]
+                self.put(key, first + k, block)
+                blocks[k] = File(block)
+            i = j
+
+        # Only copy the part of each block that falls within the range.
+        parts = []
+        for k, block in enumerate(blocks):
+            start = (first + k) * self.block_size
+            lo = max(offset, start) - start
+            parts.append(block.read(lo, min(end, start + block.size) -
+                                    start - lo))
+        return b''.join(parts)
+
+    def _forget(self, name):
+        """Drops an entry from the index (the lock must be held)."""
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self._total -= size
+
+    def _evict(self):
+        """Removes least recently used blocks until under max_bytes (the lock
+        must be held)."""
+        while self._total > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
@@ -0,0 +1,121 @@
+# coding=utf8
+
+"""Pre-rendered views of a transaction's fields.
+
+Every file under a transaction folder (and every user.monzo.* attribute) is a
+rendering of some part of the transaction dict. A FieldTable does that
+rendering once, when the transaction is first seen or when its "updated"
+timestamp changes, so reading a field is just a dictionary lookup. Tables are
+kept in a FieldTableCache, which only holds the most recently used ones.
+
+  Typical usage example:
+
+  table = FieldTable(api.get_transaction(transaction_id, True))
+  print table.get(('merchant', 'name')).read(0, 100)
+"""
+
+import collections
+import json
+import threading
+
+from monzo_fs.diazed import Dir, File
+
+# Fields holding an amount in pence, which are shown as pounds (e.g. 10.00).
+AMOUNT_FIELDS = ('amount', 'local_amount', 'account_balance')
+
+# How many tables a FieldTableCache holds unless told otherwise.
+DEFAULT_MAX_TABLES = 4096
+
+# What reading a field the transaction doesn't have gives.
+_MISSING = File(b'\n')
+
+
+def _to_bytes(path, value):
+    """Renders a scalar field (with a trailing newline)."""
+    if len(path) == 1 and path[0] in AMOUNT_FIELDS and \
+            type(value) in (int, long, float):
+        return b'%.02f\n' % (value / 100.0)
+    if type(value) is unicode:
+        return value.encode('utf8') + b'\n'
+    return bytes(value) + b'\n'
+
+
+def _stamp(transaction):
+    """What tells two versions of a transaction apart. Transactions without
+    an "updated" timestamp are compared in full."""
+    return transaction.get('updated', transaction)
+
+
+class FieldTable:
+    """The rendered fields of one version of a transaction."""
+
+    def __init__(self, transaction):
+        """Renders every field of transaction.
+
+        :param transaction: A transaction dict, which must not be modified
+                            afterwards.
+        """
+        self.stamp = _stamp(transaction)
+        self.files = {}
+        self.attrs = {}
+        self._render((), transaction)
+        self.files[()] = Dir(transaction.keys() + ['json'])
+        self.files[('json',)] = File(json.dumps(transaction))
+
+    def _render(self, path, record):
+        for key, value in record.iteritems():
+            field = path + (key,)
+            if type(value) is dict:
+                self.files[field] = Dir(value.keys())
+                self._render(field, value)
+            elif type(value) is list:
+                self.files[field] = Dir(value)
+            else:
+                contents = _to_bytes(field, value)
+                self.files[field] = File(contents)
+                self.attrs['user.monzo.' + '.'.join(field)] = contents[:-1]
+
+    def is_current(self, transaction):
+        """Whether this table was rendered from the same version of the
+        transaction."""
+        stamp = _stamp(transaction)
+        return stamp is self.stamp or stamp == self.stamp
+
+    def get(self, path):
+        """Returns the Dir or File at path (a tuple of field names)."""
+        return self.files.get(path, _MISSING)
+
+
+class FieldTableCache:
+    """Holds the most recently used FieldTables."""
+
+    def __init__(self, max_tables=DEFAULT_MAX_TABLES):
+        """Constructs a FieldTableCache.
+
+        :param max_tables: The number of tables to hold before dropping the
+                           least recently used.
+        """
+        self.max_tables = max_tables
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get(self, key, transaction):
+        """Returns the table for transaction, only rendering it if there is
+        no table for key or it was rendered from another version.
+
+        :param key: A hashable key (e.g. the transaction id).
+        :param transaction: The current version of the transaction dict.
+        :returns: A FieldTable instance.
+        """
+        with self._lock:
+            table = self._tables.pop(key, None)
+        if table is None or not table.is_current(transaction):
+            table = FieldTable(transaction)
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+        return table
@@ -15,25 +15,106 @@ for an oauth token and re-issuing it as and when required.
 
 import BaseHTTPServer
 import datetime
+import errno
+import json
+import logging
 import os
 import pickle
+import re
+import threading
 import urllib
 import urlparse
 
-import iso8601
 import requests
 import rfc3339
 
+from monzo_fs import trace
+
+
+# The largest page of transactions the API will return.
+MAX_PAGE_SIZE = 100
+
+
+def _iter_json_array(chunks, key):
+    """Incrementally decodes the items of the array under key in a JSON object
+    that arrives as a sequence of chunks (e.g. {"key": [{...}, {...}]}).
+
+    Items are yielded as soon as they have been received in full, each one is
+    decoded by the (C accelerated) json module. If the object has no such array
+    nothing is yielded.
+
+    :param chunks: An iterable of str chunks of the JSON document.
+    :param key: The key of the array to decode.
+    :returns: A generator that yields the decoded items.
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ''
+    pos = None
+    for chunk in chunks:
+        buf += chunk
+        if pos is None:
+            match = start.search(buf)
+            if match is None:
+                continue
+            pos = match.end()
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The item has not been received in full yet.
+                break
+            yield item
+
+        # Drop everything we have decoded.
+        buf = buf[pos:]
+        pos = 0
+
+    if pos is not None:
+        raise ValueError('Truncated response decoding %s.' % key)
+
+
+class _Unlimited:
+    """Stands in for a semaphore for endpoints without a concurrency limit."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
 
 class MonzoAPI:
     """Wraps authenticating, calling and de-marshaling Monzo API calls."""
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, shared_cache=None,
+                 endpoint_limits=None):
+        """Constructs a MonzoAPI instance.
+
+        :param client_id: Your Monzo API client.
+        :param client_secret: Your Monzo API secret.
+        :param shared_cache: An optional monzo_fs.shared.CacheClient to share
+                             responses with other monzo-fs processes.
+        :param endpoint_limits: An optional dict of endpoint (e.g.
+                                "transactions") to the maximum number of
+                                concurrent requests to it.
+        """
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = 'http://localhost:1234/'
         self.config_file = os.path.join(os.path.expanduser('~'), '.mondofs')
         self.oauth = None
+        self.shared_cache = shared_cache
+        self._endpoint_limits = {}
+        for endpoint, limit in (endpoint_limits or {}).iteritems():
+            self._endpoint_limits[endpoint] = threading.BoundedSemaphore(limit)
 
     def initialize(self):
         """Attempt to initialize this instance. We attempt to read an oauth
@@ -140,11 +221,12 @@ class MonzoAPI:
 
         return self.oauth.get('access_token', None)
 
-    def _get(self, path, params=None):
+    def _request(self, path, params=None, stream=False):
         """Executes a GET request to the Monzo API.
 
         :param params: An optional dictionary of parameters.
-        :returns: The de-marshaled response from the API (e.g. a dict).
+        :param stream: Whether to defer downloading the response body.
+        :returns: A requests.Response instance.
         """
         url = 'https://api.getmondo.co.uk/' + path
         if params:
@@ -152,65 +234,159 @@ class MonzoAPI:
         headers = {
             'Authorization': 'Bearer ' + self._get_access_token(),
         }
-        return requests.get(url, headers=headers).json()
+        trace.note('api')
+        return requests.get(url, headers=headers, stream=stream)
+
+    def _limit(self, path):
+        """Returns a context manager that bounds concurrent requests to the
+        endpoint (e.g. "transactions") of path."""
+        return self._endpoint_limits.get(path.split('/')[0], _Unlimited())
+
+    def _shared(self, path, params, ttl, fetch):
+        """Returns the result of fetch, via the shared cache if there is one.
+
+        :param ttl: How many seconds other processes may re-use the result.
+        :param fetch: A callable that performs the request.
+        """
+        if self.shared_cache is None:
+            return fetch()
+        # Responses are only shared between processes for the same user.
+        key = json.dumps([self.oauth.get('user_id'), path,
+                          sorted((params or {}).items())])
+        return self.shared_cache.get_or_fetch(key, ttl, fetch)
+
+    def _get(self, path, params=None, ttl=0):
+        """Executes a GET request to the Monzo API.
+
+        :param params: An optional dictionary of parameters.
+        :param ttl: How many seconds the response may be shared for.
+        :returns: The de-marshaled response from the API (e.g. a dict).
+        """
+        def fetch():
+            with self._limit(path):
+                return self._request(path, params).json()
+        return self._shared(path, params, ttl, fetch)
 
     def get_accounts(self):
         """https://getmondo.co.uk/docs/#accounts"""
-        return self._get('accounts').get('accounts', [])
+        return self._get('accounts', ttl=(24 * 60 * 60)).get('accounts', [])
 
     def get_balance(self, account_id):
         """https://getmondo.co.uk/docs/#balance"""
-        return self._get('balance', params={'account_id': account_id})
+        return self._get('balance', params={'account_id': account_id}, ttl=30)
 
-    def list_transactions(self, account_id, date_from, date_to):
+    def list_transactions(self, account_id, date_from, date_to,
+                          merchant=False):
         """https://getmondo.co.uk/docs/#list-transactions"""
-        return list(self._list_transactions(account_id, date_from, date_to))
+        return list(self.iter_transactions(account_id, date_from, date_to,
+                                           merchant))
 
-    def _list_transactions(self, account_id, date_from, date_to):
+    def iter_transactions(self, account_id, date_from, date_to,
+                          merchant=False):
         """Fetch all transactions within the given date ranges. Handles
-        pagination.
+        pagination, and yields transactions as they are received.
 
+        :param merchant: Whether to expand merchant details.
         :returns: A generator that yields all transactions within the range.
         """
-        start = date_from
-        limit = 100
+        since = rfc3339.rfc3339(date_from, use_system_timezone=False, utc=True)
+        before = rfc3339.rfc3339(date_to, use_system_timezone=False, utc=True)
         while True:
-            since = rfc3339.rfc3339(start,
-                                    use_system_timezone=False,
-                                    utc=True)
-            before = rfc3339.rfc3339(date_to,
-                                     use_system_timezone=False,
-                                     utc=True)
             params = {
                 'account_id': account_id,
-                'limit': limit,
+                'limit': MAX_PAGE_SIZE,
                 'since': since,
                 'before': before,
             }
-            response = self._get('transactions', params=params)
-            transactions = response.get('transactions', [])
-
-            last_created = None
-            for transaction in transactions:
-                created = iso8601.parse_date(transaction['created'])
-                if last_created is None or created > last_created:
-                    last_created = created
+            if merchant:
+                params['expand[]'] = 'merchant'
+
+            count = 0
+            for transaction in self._iter_page(params):
+                count += 1
+                # Pages are returned oldest first, so the last transaction is
+                # the newest (comparing timestamps as strings isn't safe, the
+                # fractional seconds vary in length).
+                since = transaction['id']
                 yield transaction
 
-            if len(transactions) < limit:
+            if count < MAX_PAGE_SIZE:
                 # No need to paginate.
                 return
 
-            start = last_created
+    def _iter_page(self, params):
+        """Yields the transactions in a page, as they are streamed in unless
+        the page is shared with other processes."""
+        if self.shared_cache is None:
+            return self._stream_page(params)
+        return iter(self._shared('transactions', params, 60,
+                                 lambda: list(self._stream_page(params))))
+
+    def _stream_page(self, params):
+        """Yields the transactions in a page as they are streamed in."""
+        with self._limit('transactions'):
+            response = self._request('transactions', params=params,
+                                     stream=True)
+            try:
+                chunks = response.iter_content(chunk_size=(16 * 1024))
+                for transaction in _iter_json_array(chunks, 'transactions'):
+                    yield transaction
+            finally:
+                response.close()
 
     def get_transaction(self, transaction_id, merchant):
         """https://getmondo.co.uk/docs/#retrieve-transaction"""
         params = {}
         if merchant:
             params['expand[]'] = 'merchant'
-        result = self._get('transactions/' + transaction_id, params=params)
+        result = self._get('transactions/' + transaction_id, params=params,
+                           ttl=(5 * 60))
         return result.get('transaction', {})
 
+    def get_attachment_size(self, file_url):
+        """Returns the size in bytes of an attachment without downloading it.
+
+        Attachment URLs are not served by the Monzo API so we intentionally
+        don't send our oauth token with the request.
+        """
+        trace.note('attachment_head')
+        r = requests.head(file_url, allow_redirects=True)
+        r.raise_for_status()
+        if 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+
+        # Some servers don't report a length for HEAD, ask for a single byte
+        # and read the total from the Content-Range header instead.
+        r = requests.get(file_url, headers={'Range': 'bytes=0-0'})
+        r.raise_for_status()
+        if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+            total = r.headers['Content-Range'].rsplit('/', 1)[1]
+            if total.isdigit():
+                return int(total)
+        elif r.status_code == 200:
+            # The server ignored the range and sent the whole attachment.
+            if 'Content-Length' in r.headers:
+                return int(r.headers['Content-Length'])
+            return len(r.content)
+
+        logging.error('Unable to tell the size of %s (status %d, '
+                      'Content-Range %r).', file_url, r.status_code,
+                      r.headers.get('Content-Range'))
+        raise OSError(errno.EIO, 'Unable to tell the size of an attachment.')
+
+    def get_attachment_range(self, file_url, offset, size):
+        """Returns size bytes from offset in the attachment at file_url."""
+        headers = {
+            'Range': 'bytes=%d-%d' % (offset, offset + size - 1),
+        }
+        trace.note('attachment_get')
+        r = requests.get(file_url, headers=headers)
+        r.raise_for_status()
+        if r.status_code == 206:
+            return r.content
+        # The server ignored our range and sent the whole file.
+        return r.content[offset:offset + size]
+
 
 class HTTPServer(BaseHTTPServer.BaseHTTPRequestHandler):
     """An HTTP server capable of handling a GET request."""
@@ -0,0 +1,266 @@
+# coding=utf8
+
+"""Columnar time series built from an account's transactions.
+
+A TransactionSeries holds one column per transaction attribute that we chart
+(created, amount, category) and a set of aggregates over those columns (running
+balance, spend per day and spend per category per month). New transactions are
+appended in batches and only the new rows are folded into the aggregates, so
+keeping the series up to date never requires a pass over the full history.
+
+A CombinedSeries renders the same files across several accounts by merging
+their series.
+
+  Typical usage example:
+
+  series = TransactionSeries()
+  series.extend(api.iter_transactions(account_id, date_from, date_to))
+  print series.daily_spend_csv()
+"""
+
+import array
+import collections
+import heapq
+import threading
+
+
+def _to_2dp(pence):
+    return '%.02f' % (pence / 100.0)
+
+
+def _daily_spend_csv(daily_spend):
+    return ''.join(['date,spend\n'] +
+                   ['%s,%s\n' % (day, _to_2dp(daily_spend[day]))
+                    for day in sorted(daily_spend)])
+
+
+def _category_by_month_csv(category_by_month):
+    return ''.join(['month,category,spend\n'] +
+                   ['%s,%s,%s\n' % (month, category, _to_2dp(spend))
+                    for (month, category), spend in
+                    sorted(category_by_month.iteritems())])
+
+
+class TransactionSeries:
+    """An incrementally updated, columnar view of an account's history."""
+
+    def __init__(self):
+        # Columns (one row per transaction, in the order they were created).
+        self.ids = set()
+        self.created = []
+        self.amount = array.array('l')
+        self.category = []
+        self.declined = array.array('b')
+
+        # Aggregates over the columns above.
+        self.balance = array.array('l')
+        self.daily_spend = collections.defaultdict(int)
+        self.category_by_month = collections.defaultdict(int)
+
+        # Bumped every time rows are appended, used to memoise rendering.
+        self.version = 0
+        self._rendered = {}
+        self._running_balance_csv = bytearray(b'created,balance\n')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.created)
+
+    @property
+    def last_created(self):
+        """The created timestamp of the newest transaction (or None)."""
+        return self.created[-1] if self.created else None
+
+    def extend(self, transactions):
+        """Appends transactions (oldest first) that are not already present.
+
+        :param transactions: An iterable of transaction dicts.
+        :returns: The number of rows that were appended.
+        """
+        with self._lock:
+            return self._extend(transactions)
+
+    def update(self, fetch):
+        """Appends the transactions returned by fetch(last_created). Only one
+        thread fetches at a time, so later callers only fetch what the first
+        one didn't.
+
+        :param fetch: A callable taking the created timestamp of the newest
+                      transaction (or None) and returning an iterable of
+                      transaction dicts (oldest first) from then on.
+        :returns: The number of rows that were appended.
+        """
+        with self._lock:
+            return self._extend(fetch(self.last_created))
+
+    def _extend(self, transactions):
+        """Appends transactions (the lock must be held)."""
+        ids = set()
+        created = []
+        amount = array.array('l')
+        category = []
+        declined = array.array('b')
+        for transaction in transactions:
+            if transaction['id'] in self.ids or transaction['id'] in ids:
+                continue
+            ids.add(transaction['id'])
+            created.append(transaction['created'])
+            amount.append(transaction.get('amount', 0))
+            category.append(transaction.get('category', ''))
+            declined.append(1 if transaction.get('decline_reason') else 0)
+
+        if not ids:
+            return 0
+
+        # Everything that can fail is done before anything is modified, so
+        # the columns and aggregates never get out of step.
+        aggregates = self._aggregate(created, amount, category, declined)
+
+        self.ids.update(ids)
+        self.created.extend(created)
+        self.amount.extend(amount)
+        self.category.extend(category)
+        self.declined.extend(declined)
+        self._apply(*aggregates)
+        self.version += 1
+        return len(ids)
+
+    def _aggregate(self, created, amount, category, declined):
+        """Computes what new rows add to the aggregates.
+
+        This is a plain per-row pass over the new rows (nothing is vectorised,
+        the array module has no bulk arithmetic), the saving comes from never
+        revisiting rows that were already folded in.
+
+        :returns: A tuple of the new balance rows, running balance CSV bytes,
+                  and daily and category by month spend to add.
+        """
+        # Declined transactions don't move money.
+        settled = array.array('l', (a * (1 - d) for a, d in zip(amount,
+                                                                declined)))
+
+        # Running balance is the cumulative sum continued from the last row.
+        total = self.balance[-1] if self.balance else 0
+        balance = array.array('l')
+        lines = []
+        for c, a, d in zip(created, settled, declined):
+            total += a
+            balance.append(total)
+            if not d:
+                lines.append(u'%s,%s\n' % (c, _to_2dp(total)))
+        # Timestamps decoded from JSON are unicode, which bytearrays refuse.
+        csv = u''.join(lines).encode('utf8')
+
+        # Spend is money leaving the account, grouped by day and by month.
+        daily_spend = collections.defaultdict(int)
+        category_by_month = collections.defaultdict(int)
+        for c, a, cat in zip(created, settled, category):
+            if a < 0:
+                daily_spend[c[:10]] -= a
+                category_by_month[(c[:7], cat)] -= a
+
+        return balance, csv, daily_spend, category_by_month
+
+    def _apply(self, balance, csv, daily_spend, category_by_month):
+        """Adds the result of _aggregate to the aggregates."""
+        self.balance.extend(balance)
+        self._running_balance_csv.extend(csv)
+        for day, spend in daily_spend.iteritems():
+            self.daily_spend[day] += spend
+        for key, spend in category_by_month.iteritems():
+            self.category_by_month[key] += spend
+
+    def _memoise(self, name, render):
+        version, contents = self._rendered.get(name, (None, None))
+        if version != self.version:
+            contents = render()
+            self._rendered[name] = (self.version, contents)
+        return contents
+
+    def daily_spend_csv(self):
+        """Returns the total spend per day as CSV."""
+        return self._memoise('daily_spend',
+                             lambda: _daily_spend_csv(self.daily_spend))
+
+    def category_by_month_csv(self):
+        """Returns the total spend per category per month as CSV."""
+        return self._memoise(
+            'category_by_month',
+            lambda: _category_by_month_csv(self.category_by_month))
+
+    def running_balance_csv(self):
+        """Returns the balance after each transaction as CSV.
+
+        The returned buffer is appended to in place as rows arrive, callers
+        should only read the bytes that were present when they called this.
+        """
+        return self._running_balance_csv
+
+
+def _sum(counts):
+    """Adds up a list of dicts of totals."""
+    total = collections.defaultdict(int)
+    for c in counts:
+        for key, value in c.items():
+            total[key] += value
+    return total
+
+
+class CombinedSeries:
+    """The aggregates of several TransactionSeries (e.g. every account)."""
+
+    def __init__(self, series):
+        """Constructs a CombinedSeries.
+
+        :param series: A list of TransactionSeries, which may keep growing.
+        """
+        self.series = series
+        self._rendered = {}
+
+    @property
+    def version(self):
+        return tuple(s.version for s in self.series)
+
+    def _memoise(self, name, render):
+        version, contents = self._rendered.get(name, (None, None))
+        if version != self.version:
+            version = self.version
+            contents = render()
+            self._rendered[name] = (version, contents)
+        return contents
+
+    def daily_spend_csv(self):
+        """Returns the total spend per day across all series as CSV."""
+        return self._memoise('daily_spend', lambda: _daily_spend_csv(
+            _sum([s.daily_spend for s in self.series])))
+
+    def category_by_month_csv(self):
+        """Returns the total spend per category per month across all series
+        as CSV."""
+        return self._memoise(
+            'category_by_month',
+            lambda: _category_by_month_csv(
+                _sum([s.category_by_month for s in self.series])))
+
+    def running_balance_csv(self):
+        """Returns the sum of the balances of all series after each
+        transaction (in created order) as CSV."""
+        return self._memoise('running_balance', self._running_balance_csv)
+
+    def _running_balance_csv(self):
+        rows = []
+        for i, s in enumerate(self.series):
+            # Only read the rows that have been fully aggregated.
+            n = len(s.balance)
+            rows.append(zip(s.created[:n], [i] * n, s.balance[:n],
+                            s.declined[:n]))
+
+        latest = [0] * len(self.series)
+        total = 0
+        lines = ['created,balance\n']
+        for c, i, balance, declined in heapq.merge(*rows):
+            total += balance - latest[i]
+            latest[i] = balance
+            if not declined:
+                lines.append('%s,%s\n' % (c, _to_2dp(total)))
+        return ''.join(lines)
@@ -0,0 +1,204 @@
+# coding=utf8
+
+"""A cache shared by every monzo-fs process on a host.
+
+Several mounts (e.g. one per tool) would otherwise each spend API quota
+fetching the same data. The cache daemon listens on a Unix socket and holds API
+responses until they expire. Clients ask it before calling the API, and fetches
+are single-flight across processes: the first client to miss a key is given a
+lease to fetch it, and others asking for the same key wait for that client to
+put the value rather than fetching it again.
+
+The daemon only deduplicates API calls. Each process still keeps its own
+in-memory caches (e.g. rendered transactions and series) built from the
+responses, so memory use per mount is unchanged.
+
+Requests and responses are lines of JSON:
+
+  {"op": "get", "key": k}              -> {"status": "hit", "value": v}
+                                       or {"status": "fetch"} (we hold a lease)
+  {"op": "put", "key": k, "value": v,
+   "ttl": seconds}                     -> {"status": "ok"}
+  {"op": "release", "key": k}          -> {"status": "ok"} (the fetch failed)
+
+The socket is only accessible by the user that started the daemon. Keys should
+be namespaced by the Monzo user they belong to.
+
+  Typical usage example:
+
+  CacheDaemon(DEFAULT_SOCKET).serve_forever()
+  ...
+  client = CacheClient(DEFAULT_SOCKET)
+  balance = client.get_or_fetch(key, 30, lambda: fetch_balance())
+"""
+
+import json
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+from monzo_fs import trace
+
+# Where the daemon listens unless told otherwise.
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.mondofs.sock')
+
+# How long a client may take to fetch a key before others may try.
+LEASE_SECONDS = 30
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Handles requests from one client connection."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            request = json.loads(line)
+            response = self.server.handle_request_dict(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class CacheDaemon(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    """Holds cached values for clients connecting over a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        """Constructs a CacheDaemon listening on the socket at path.
+
+        :param path: The path of the Unix socket (replaced if it exists and
+                     no daemon is listening on it).
+        """
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left behind by a daemon that has exited.
+                os.remove(path)
+            else:
+                raise Exception('A cache daemon is already listening on %s.'
+                                % path)
+            finally:
+                probe.close()
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+        self.values = {}
+        self.leases = {}
+        self.cond = threading.Condition()
+        self._puts = 0
+
+    def handle_request_dict(self, request):
+        op = request.get('op')
+        key = request.get('key')
+        with self.cond:
+            if op == 'get':
+                return self._get(key)
+            elif op == 'put':
+                self._put(key, request['value'], request['ttl'])
+            elif op == 'release':
+                self.leases.pop(key, None)
+                self.cond.notify_all()
+            else:
+                return {'status': 'error', 'error': 'Unknown op %s.' % op}
+            return {'status': 'ok'}
+
+    def _get(self, key):
+        """Returns a hit, or hands out a lease once nobody else holds one (the
+        condition must be held)."""
+        while True:
+            now = time.time()
+            expires, value = self.values.get(key, (0, None))
+            if now < expires:
+                return {'status': 'hit', 'value': value}
+            if self.leases.get(key, 0) < now:
+                self.leases[key] = now + LEASE_SECONDS
+                return {'status': 'fetch'}
+            # Somebody else is fetching this key, wait for their put.
+            self.cond.wait(self.leases[key] - now)
+
+    def _put(self, key, value, ttl):
+        """Stores a value and wakes up waiters (the condition must be held)."""
+        now = time.time()
+        self.values[key] = (now + ttl, value)
+        self.leases.pop(key, None)
+        self.cond.notify_all()
+
+        # Every so often drop expired values so memory doesn't grow forever.
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            for k in [k for k, (e, _) in self.values.iteritems() if e < now]:
+                del self.values[k]
+
+
+class CacheClient:
+    """Talks to a CacheDaemon, falling back to fetching directly if the daemon
+    can't be reached."""
+
+    def __init__(self, path):
+        """Constructs a CacheClient.
+
+        :param path: The path of the daemon's Unix socket.
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _call(self, request):
+        """Sends a request on this thread's connection, returning the reply."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            conn = self._local.conn = sock.makefile('rw')
+        try:
+            conn.write(json.dumps(request) + '\n')
+            conn.flush()
+            line = conn.readline()
+            if not line:
+                raise socket.error('Cache daemon closed the connection.')
+            return json.loads(line)
+        except:
+            self._local.conn = None
+            raise
+
+    def get_or_fetch(self, key, ttl, fetch):
+        """Returns the value for key from the daemon, or calls fetch (at most
+        once across all clients at a time) and shares the result.
+
+        :param key: A str that uniquely identifies the value.
+        :param ttl: How many seconds the fetched value should be shared for.
+        :param fetch: A callable that produces the (JSON serializable) value.
+        :returns: The value.
+        """
+        try:
+            response = self._call({'op': 'get', 'key': key})
+        except socket.error as e:
+            logging.warning('Cache daemon unavailable (%s).', e)
+            return fetch()
+
+        if response['status'] == 'hit':
+            trace.note('shared_hit')
+            return response['value']
+
+        trace.note('shared_miss')
+        try:
+            value = fetch()
+        except:
+            try:
+                self._call({'op': 'release', 'key': key})
+            except socket.error:
+                pass
+            raise
+
+        try:
+            self._call({'op': 'put', 'key': key, 'value': value, 'ttl': ttl})
+        except socket.error as e:
+            logging.warning('Cache daemon unavailable (%s).', e)
+        return value
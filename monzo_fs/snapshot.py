@@ -0,0 +1,238 @@
+# coding=utf8
+
+"""A compact, columnar, offline copy of a Monzo account.
+
+A snapshot freezes accounts, balances and transactions (with merchant details)
+into a single file that can be mounted without credentials or network access.
+SnapshotAPI implements the same methods as MonzoAPI, so every route in the file
+system works unchanged when it is installed as the MonzoAPI singleton.
+
+The file is laid out as:
+
+  magic | header offset | header length | records | columns... | header
+
+Records are the JSON encoded transactions. Transactions are ordered by account
+and then by created time, and the columns hold one fixed width value per row:
+
+  ids       the transaction id, NUL padded to the width given in the header.
+  created   microseconds since the epoch (little endian int64).
+  spans     the start and end offsets of the row's record (2x uint64).
+  id_order  row numbers sorted by transaction id (uint32).
+
+The header is a small JSON object holding the accounts, balances, the row range
+of each account and the offset of each column. Opening a snapshot only parses
+the header, everything else is read on demand from a memory map.
+
+  Typical usage example:
+
+  write_snapshot(api, '/tmp/monzo.snapshot')
+  singleton(MonzoAPI, SnapshotAPI('/tmp/monzo.snapshot'))
+"""
+
+import bisect
+import calendar
+import datetime
+import errno
+import json
+import logging
+import mmap
+import os
+import struct
+
+import iso8601
+
+MAGIC = b'MZFSNAP1'
+
+_PREAMBLE = struct.Struct('<8sQQ')
+
+
+def _to_micros(dt):
+    """Converts a (naive UTC or timezone aware) datetime to epoch micros."""
+    if dt.utcoffset() is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    return calendar.timegm(dt.timetuple()) * 1000000 + dt.microsecond
+
+
+def _months(date_from, date_to):
+    """Yields (start, end) datetimes for each month between the two dates."""
+    year, month = date_from.year, date_from.month
+    while (year, month) <= (date_to.year, date_to.month):
+        start = datetime.datetime(year, month, 1)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        yield start, datetime.datetime(year, month, 1)
+
+
+def write_snapshot(api, path):
+    """Dumps everything visible to api into a snapshot file at path.
+
+    :param api: An initialized MonzoAPI instance.
+    :param path: Where to write the snapshot.
+    """
+    accounts = api.get_accounts()
+    balances = {}
+    account_rows = {}
+    ids = []
+    created = []
+    spans = []
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fp:
+        fp.write(b'\0' * _PREAMBLE.size)
+
+        for account in accounts:
+            account_id = account['id']
+            logging.info('Snapshotting %s', account_id)
+            balances[account_id] = api.get_balance(account_id)
+
+            rows = []
+            now = datetime.datetime.utcnow()
+            first = iso8601.parse_date(account['created'])
+            for date_from, date_to in _months(first, now):
+                for transaction in api.iter_transactions(account_id,
+                                                         date_from,
+                                                         date_to,
+                                                         merchant=True):
+                    record = json.dumps(transaction, separators=(',', ':'))
+                    start = fp.tell()
+                    fp.write(record)
+                    micros = _to_micros(
+                        iso8601.parse_date(transaction['created']))
+                    rows.append((micros, transaction['id'], start, fp.tell()))
+
+            # Rows are ordered by created time within each account.
+            rows.sort()
+            account_rows[account_id] = [len(ids), len(ids) + len(rows)]
+            for micros, transaction_id, start, end in rows:
+                ids.append(str(transaction_id))
+                created.append(micros)
+                spans.extend((start, end))
+
+        columns = {}
+        width = max([len(i) for i in ids] or [1])
+
+        def write_column(name, data):
+            columns[name] = [fp.tell(), len(data)]
+            fp.write(data)
+
+        write_column('ids', b''.join(i.ljust(width, b'\0') for i in ids))
+        write_column('created', struct.pack('<%dq' % len(created), *created))
+        write_column('spans', struct.pack('<%dQ' % len(spans), *spans))
+        id_order = sorted(xrange(len(ids)), key=ids.__getitem__)
+        write_column('id_order',
+                     struct.pack('<%dI' % len(id_order), *id_order))
+
+        header = json.dumps({
+            'accounts': accounts,
+            'balances': balances,
+            'account_rows': account_rows,
+            'columns': columns,
+            'count': len(ids),
+            'id_width': width,
+        })
+        header_offset = fp.tell()
+        fp.write(header)
+        fp.seek(0)
+        fp.write(_PREAMBLE.pack(MAGIC, header_offset, len(header)))
+
+    os.rename(tmp, path)
+
+
+class _Column:
+    """A read only sequence of fixed width values in a memory map."""
+
+    def __init__(self, buf, offset, length, fmt):
+        self.buf = buf
+        self.offset = offset
+        self.struct = struct.Struct(fmt)
+        self.length = length // self.struct.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.struct.unpack_from(self.buf,
+                                       self.offset + i * self.struct.size)[0]
+
+
+class SnapshotAPI:
+    """Serves the MonzoAPI interface from a snapshot file."""
+
+    def __init__(self, path):
+        """Opens (memory maps) the snapshot at path.
+
+        :param path: The path of a file created with write_snapshot.
+        """
+        with open(path, 'rb') as fp:
+            self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, offset, length = _PREAMBLE.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise Exception('%s is not a monzo-fs snapshot.' % path)
+        self.header = json.loads(self.buf[offset:offset + length])
+
+        columns = self.header['columns']
+        width = self.header['id_width']
+        self.ids = _Column(self.buf, columns['ids'][0], columns['ids'][1],
+                           '%ds' % width)
+        self.created = _Column(self.buf, columns['created'][0],
+                               columns['created'][1], '<q')
+        self.spans = _Column(self.buf, columns['spans'][0],
+                             columns['spans'][1], '<Q')
+        self.id_order = _Column(self.buf, columns['id_order'][0],
+                                columns['id_order'][1], '<I')
+
+    def initialize(self):
+        """Snapshots need no authorization."""
+        pass
+
+    def _record(self, row):
+        start = self.spans[2 * row]
+        return json.loads(self.buf[start:self.spans[2 * row + 1]])
+
+    def get_accounts(self):
+        return self.header['accounts']
+
+    def get_balance(self, account_id):
+        return self.header['balances'].get(account_id, {})
+
+    def list_transactions(self, account_id, date_from, date_to,
+                          merchant=False):
+        return list(self.iter_transactions(account_id, date_from, date_to,
+                                           merchant))
+
+    def iter_transactions(self, account_id, date_from, date_to,
+                          merchant=False):
+        start, end = self.header['account_rows'].get(account_id, [0, 0])
+        lo = bisect.bisect_left(self.created, _to_micros(date_from),
+                                start, end)
+        hi = bisect.bisect_left(self.created, _to_micros(date_to), lo, end)
+        for row in xrange(lo, hi):
+            yield self._transaction(row, merchant)
+
+    def get_transaction(self, transaction_id, merchant):
+        key = str(transaction_id).ljust(self.header['id_width'], b'\0')
+        lo, hi = 0, len(self.id_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ids[self.id_order[mid]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.id_order) and self.ids[self.id_order[lo]] == key:
+            return self._transaction(self.id_order[lo], merchant)
+        return {}
+
+    def _transaction(self, row, merchant):
+        transaction = self._record(row)
+        if not merchant and type(transaction.get('merchant')) is dict:
+            # Without expansion the API only returns the merchant id.
+            transaction['merchant'] = transaction['merchant'].get('id')
+        return transaction
+
+    def get_attachment_size(self, file_url):
+        raise OSError(errno.ENOENT, 'Attachments are not snapshotted.')
+
+    def get_attachment_range(self, file_url, offset, size):
+        raise OSError(errno.ENOENT, 'Attachments are not snapshotted.')
@@ -0,0 +1,193 @@
+# coding=utf8
+
+"""Records FUSE operations to a trace file and replays them as load.
+
+A TraceRecorder can be attached to a diazed file system, which will then log
+every operation it handles as a line of JSON. Each line holds the operation,
+its arguments, the thread it ran on, start/end timestamps, any error and a
+count of notable events (e.g. cache hits or API calls) that happened while
+handling it. Code anywhere in monzo-fs can report events with note().
+
+replay() re-issues a trace against a file system, either at the original pace
+or accelerated, and reports latency percentiles per operation.
+
+  Typical usage example:
+
+  diazed.fs.recorder = TraceRecorder(open('/tmp/monzo.trace', 'a', 1))
+  ...
+  stats = replay(load('/tmp/monzo.trace'), diazed.fs, speed=10)
+  print format_stats(stats)
+"""
+
+import collections
+import json
+import threading
+import time
+import Queue
+
+_local = threading.local()
+
+# Operations that only make sense once per mount and are not replayed.
+_SKIP = frozenset(['init', 'destroy'])
+
+
+def note(event):
+    """Counts event (e.g. "cache_hit") against the operation being traced on
+    the current thread. Does nothing if no operation is being traced.
+
+    :param event: The str name of the event.
+    """
+    events = getattr(_local, 'events', None)
+    if events is not None:
+        events[event] += 1
+
+
+def _jsonable(value):
+    if value is None or type(value) in (bool, int, long, float, str, unicode):
+        return value
+    return repr(value)
+
+
+class TraceRecorder:
+    """Writes a line of JSON per traced operation to a file object."""
+
+    def __init__(self, fp):
+        """Constructs a TraceRecorder.
+
+        :param fp: A file object to write the trace to.
+        """
+        self.fp = fp
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Called before an operation is handled on the current thread."""
+        _local.events = collections.defaultdict(int)
+
+    def wrap(self, fn):
+        """Returns a callable that runs fn on any thread, counting its events
+        against the operation being traced on the current thread."""
+        events = getattr(_local, 'events', None)
+
+        def _wrapped():
+            previous = getattr(_local, 'events', None)
+            _local.events = events
+            try:
+                return fn()
+            finally:
+                _local.events = previous
+        return _wrapped
+
+    def record(self, op, args, start, end, error=None):
+        """Called after an operation has been handled on the current thread.
+
+        :param op: The str name of the operation (e.g. "read").
+        :param args: The arguments of the operation (the first is the path).
+        :param start: The time.time() the operation started.
+        :param end: The time.time() the operation finished.
+        :param error: The errno or exception name if the operation failed.
+        """
+        events = getattr(_local, 'events', None) or {}
+        _local.events = None
+        line = json.dumps({
+            'op': op,
+            'path': _jsonable(args[0]) if args else None,
+            'args': [_jsonable(a) for a in args[1:]],
+            'thread': threading.current_thread().name,
+            'start': start,
+            'end': end,
+            'error': error,
+            'events': events,
+        }, separators=(',', ':'))
+        with self._lock:
+            self.fp.write(line + '\n')
+
+
+def load(path):
+    """Reads the records from a trace file, ordered by start time.
+
+    :param path: The path of a trace written by a TraceRecorder.
+    :returns: A list of record dicts.
+    """
+    with open(path, 'r') as fp:
+        records = [json.loads(line) for line in fp if line.strip()]
+    return sorted(records, key=lambda r: r['start'])
+
+
+def replay(records, fs, speed=1.0, concurrency=8):
+    """Re-issues the operations in records against fs.
+
+    :param records: Records as returned by load().
+    :param fs: A fuse.Operations instance (e.g. diazed.fs).
+    :param speed: How much faster than recorded to issue operations, or 0 to
+                  issue them as fast as possible.
+    :param concurrency: The number of threads issuing operations.
+    :returns: A dict of op -> list of (latency in seconds, error).
+    """
+    records = [r for r in records if r['op'] not in _SKIP]
+    stats = collections.defaultdict(list)
+    lock = threading.Lock()
+    queue = Queue.Queue(maxsize=(concurrency * 4))
+
+    def worker():
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            args = [record['path']] + record['args']
+            error = None
+            start = time.time()
+            try:
+                fs(record['op'], *args)
+            except OSError as e:
+                error = e.errno
+            except Exception as e:
+                error = type(e).__name__
+            latency = time.time() - start
+            with lock:
+                stats[record['op']].append((latency, error))
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    began = time.time()
+    for record in records:
+        if speed:
+            delay = (record['start'] - records[0]['start']) / speed
+            wait = began + delay - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        queue.put(record)
+
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    return stats
+
+
+def percentile(values, p):
+    """Returns the p'th percentile (nearest rank) of a sorted list."""
+    if not values:
+        return 0.0
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def format_stats(stats):
+    """Formats the result of replay() as a table of latency percentiles."""
+    lines = ['%-12s %8s %8s %8s %8s %8s %8s' % (
+        'op', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors')]
+    for op in sorted(stats):
+        latencies = sorted(l for l, _ in stats[op])
+        errors = sum(1 for _, e in stats[op] if e is not None)
+        lines.append('%-12s %8d %8.2f %8.2f %8.2f %8.2f %8d' % (
+            op, len(latencies),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000,
+            errors))
+    return '\n'.join(lines)
@@ -20,7 +20,7 @@ setuptools.setup(
             'monzo-fs = monzo_fs.__main__:main',
         ],
     },
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['tests']),
     include_package_data=True,
     install_requires=['requests',
                       'fusepy>=2.0.4',
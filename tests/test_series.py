@@ -0,0 +1,66 @@
+# coding=utf8
+
+"""Tests for monzo_fs.series."""
+
+import json
+import unittest
+
+from monzo_fs.series import TransactionSeries
+
+# Transactions as the API returns them (decoded from JSON, so unicode).
+_TRANSACTIONS = json.dumps([
+    {'id': 'tx_1', 'created': '2016-08-01T10:00:00Z', 'amount': 10000,
+     'category': 'general'},
+    {'id': 'tx_2', 'created': '2016-08-01T12:00:00.5Z', 'amount': -350,
+     'category': 'eating_out'},
+    {'id': 'tx_3', 'created': '2016-08-02T09:00:00Z', 'amount': -1000,
+     'category': 'eating_out', 'decline_reason': 'INSUFFICIENT_FUNDS'},
+    {'id': 'tx_4', 'created': '2016-09-01T09:00:00Z', 'amount': -150,
+     'category': u'café'},
+])
+
+
+class TransactionSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.series = TransactionSeries()
+        self.series.extend(json.loads(_TRANSACTIONS))
+
+    def test_running_balance(self):
+        self.assertEqual(
+            bytes(self.series.running_balance_csv()),
+            b'created,balance\n'
+            b'2016-08-01T10:00:00Z,100.00\n'
+            b'2016-08-01T12:00:00.5Z,96.50\n'
+            b'2016-09-01T09:00:00Z,95.00\n')
+
+    def test_daily_spend(self):
+        self.assertEqual(self.series.daily_spend_csv(),
+                         'date,spend\n'
+                         '2016-08-01,3.50\n'
+                         '2016-09-01,1.50\n')
+
+    def test_category_by_month(self):
+        self.assertEqual(self.series.category_by_month_csv(),
+                         u'month,category,spend\n'
+                         u'2016-08,eating_out,3.50\n'
+                         u'2016-09,café,1.50\n')
+
+    def test_extend_skips_known_transactions(self):
+        version = self.series.version
+        self.assertEqual(self.series.extend(json.loads(_TRANSACTIONS)), 0)
+        self.assertEqual(self.series.version, version)
+        self.assertEqual(len(self.series), 4)
+
+    def test_failed_extend_changes_nothing(self):
+        version = self.series.version
+        with self.assertRaises(KeyError):
+            self.series.extend([{'id': 'tx_5', 'created': '2016-09-02',
+                                 'amount': -1}, {'id': 'tx_6'}])
+        self.assertEqual(self.series.version, version)
+        self.assertEqual(len(self.series), 4)
+        self.assertEqual(len(self.series.balance), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()